@@ -26,6 +26,34 @@ CONTINUE_RUNNING = True
 # Does not apply to the room entering downloads, there no duplicates will be stored
 ALLOW_DUPLICATES = True
 
+# ## NEAR DUPLICATE DETECTION
+# Re-uploads often differ from the original only by tags, resolution suffixes, whitespace or extension case.
+# Names get normalized with the regexes below (matches are removed) before they are compared to the
+# unified duplicate log. A name counts as a near duplicate if it is similar enough to a logged name and the
+# size differs by at most NEAR_DUPLICATE_SIZE_TOLERANCE (fraction of the size, 0.01 -> 1%).
+# Parentheses with only a year in them are kept, "Movie (1998)" and "Movie (2019)" are different files.
+# Numbers left after normalizing always have to match exactly.
+NEAR_DUPLICATE_NORMALIZE_RE = [
+    r"[\[{][^\]}]*[\]}]",
+    r"\((?!\s*(19|20)\d\d\s*\))[^)]*\)",
+    r"\b\d{3,4}[pi]\b",
+    r"\b\d{3,4}x\d{3,4}\b",
+    r"\b(x26[45]|h\.?26[45]|hevc|av1|web-?dl|web-?rip|bluray|remux)\b",
+]
+NEAR_DUPLICATE_SIZE_TOLERANCE = 0.01
+# Minimum similarity (0.0 - 1.0) of two normalized names to count as a near duplicate
+NEAR_DUPLICATE_SIMILARITY = 0.8
+# Number of the newest entries of the unified duplicate log that are compared against, bounds memory use
+# and startup time (roughly 30 MB and 2 seconds to load for 50000 entries)
+NEAR_DUPLICATE_HISTORY = 50000
+# What to do with near duplicates: skip, defer or download. Deferred files are not downloaded but written
+# once to the manifest LOG_PATH/[ROOM] deferred.csv, check them and download them later with:
+#   python3 manifest.py download --policy download "./logs/[ROOM] deferred.csv"
+# Without --policy download the batch applies this policy again and the deferred files stay deferred.
+# Example: NEAR_DUPLICATE_POLICY = ['skip', 'download#gentoomen']
+# This example skips near duplicates in all rooms but still downloads them in the room 'gentoomen'
+NEAR_DUPLICATE_POLICY = ['download']
+
 # Volafile user for downloading. Useful if you have volafile pro for a higher speed.
 VOLAFILE_USER = ''
 VOLAFILE_USER_PASSWORD = ''
@@ -33,6 +61,17 @@ VOLAFILE_USER_PASSWORD = ''
 # Maximum allowed size to download in MB -> unlimited if -1
 MAXIMUM_FILE_SIZE = -1
 
+# #### DOWNLOAD CONCURRENCY
+# The number of parallel downloads and their read size get tuned automatically from the measured
+# throughput and error rate. Set both transfer limits to 1 to download one file after another.
+AUTOTUNE_MIN_TRANSFERS = 1
+AUTOTUNE_MAX_TRANSFERS = 6
+# Read size per transfer in bytes
+AUTOTUNE_MIN_CHUNK_SIZE = 64 * 1024
+AUTOTUNE_MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# Seconds between two adjustments
+AUTOTUNE_INTERVAL = 5
+
 # Does the chat logger start -> True/False (can be overwritten in start command)
 LOGGER = True
 
@@ -40,6 +79,10 @@ LOGGER = True
 # Make sure this path exists beforehand
 LOG_PATH = './logs/'
 
+# Number of downloaded and of deferred urls per room that are kept in memory to skip them quickly. Older
+# downloaded urls are still caught by the unified duplicate log.
+DOWNLOADED_URLS_CACHE = 100000
+
 # #### FILTERING OPTIONS
 # All filters get stored as strings in lists. You can only use either a white- or a blacklist from each filter.
 # If you want to specify filters for a certain room put #ROOMNAME behind the filter. (This works for all filters)
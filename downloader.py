@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
-from tqdm import tqdm
 import argparse
-import requests
 import string
 import random
 from datetime import datetime, timedelta, date
 import time
 from pathlib import Path
 import re
+import csv
+import threading
 
 from jdownloader import JDownloaderCore
 from volapi import Room
@@ -15,15 +15,24 @@ from volapi import Room
 import config
 from theme import bcolors, print_file_info, short_time
 import unified_duplicate_checker
+from throughput import TransferPool
+from records import FileRecord, LRUSet, append_manifest
 
 class VolaDLException(Exception):
     def __init__(self, kill=False):
         self.kill = kill
 
 class VolaDL(object):
-    def __init__(self, room, password, downloader=None, logger=None, myjdownloader=None, jdownloader=None, folder=None):
-        """Initialize Object"""
+    def __init__(self, room, password, downloader=None, logger=None, myjdownloader=None, jdownloader=None, folder=None,
+                 transfers=None, near_duplicate_policy=None):
+        """Initialize Object
+        transfers is the TransferPool for downloads, pass one to share it between reconnects
+        near_duplicate_policy overrides NEAR_DUPLICATE_POLICY"""
         self.counter = 0
+        self.last_decision = None
+        self.listen = None
+        self.jdcore = None
+        self.closed = False
         self.headers = config.HEADERS
         self.cookies = config.COOKIES
         self.downloader = config.DOWNLOADER
@@ -79,6 +88,21 @@ class VolaDL(object):
         # Load previously downloaded files so we don't download them again
         self.jd_logpath = Path(config.LOG_PATH) / ("[" + self.room + "] downloaded.txt")
         self.jd_downloaded_urls = self.get_logged_urls(self.jd_logpath)
+        self.deferred_logpath = Path(config.LOG_PATH) / ("[" + self.room + "] deferred.csv")
+        self.deferred_urls = self.get_deferred_urls(self.deferred_logpath)
+        self.near_duplicate_policy = near_duplicate_policy
+        if self.near_duplicate_policy is None:
+            try:
+                self.near_duplicate_policy = unified_duplicate_checker.near_duplicate_policy(self.room)
+            except ValueError as err:
+                print(f'{bcolors.FAIL}### {err}, CHECK NEAR_DUPLICATE_POLICY IN YOUR CONFIG.{bcolors.ENDC}')
+                raise VolaDLException(kill=True)
+        if self.near_duplicate_policy != "download":
+            # build the index now instead of on the first lookup in the listener
+            unified_duplicate_checker.near_index()
+
+        self.own_transfers = transfers is None
+        self.transfers = transfers or TransferPool.from_config()
 
         if self.config_check():
             print(bcolors.FAIL+'### YOU CAN NOT USE A BLACKLIST AND A WHITELIST FOR THE SAME FILTER.'+bcolors.ENDC)
@@ -89,14 +113,17 @@ class VolaDL(object):
 
         def onfile(f):
             """Listener on new files in the room"""
+            if self.closed:
+                return
             if self.max_file_size > -1 and f.size / 1048576 >= self.max_file_size:
                 print_file_info(f)
                 print(bcolors.FAIL + 'File is too big to download.' + bcolors.ENDC)
             elif self.file_check(f):
-                self.single_file_download(f, quiet=False)
+                self.single_file_download(FileRecord.from_file(f), quiet=False)
             else:
                 print_file_info(f)
                 print(f'  {bcolors.WARNING}File got filtered out.{bcolors.ENDC}')
+            self.release_file(f)
 
         def ontime(t):
             """React to time events emitted by volafile socket connection, used for maintenance"""
@@ -129,6 +156,8 @@ class VolaDL(object):
             self.download_room(firstStart=firstStart)
             self.duplicate = duplicate_temp
         if not self.continue_running:
+            # the room gets downloaded before stopping, Ctrl-C cancels it
+            self.transfers.join()
             raise VolaDLException(kill=True)
         if self.downloader:
             self.listen.add_listener("file", onfile)
@@ -172,51 +201,89 @@ class VolaDL(object):
                 print_file_info(f)
                 print(bcolors.FAIL + 'File is too big to download.' + bcolors.ENDC)
             elif self.file_check(f):
-                self.single_file_download(f, quiet=not firstStart)
+                self.single_file_download(FileRecord.from_file(f), quiet=not firstStart)
             elif firstStart:
                 print_file_info(f)
                 print(bcolors.WARNING + '  File got filtered out.' + bcolors.ENDC)
+        # every file of the room is decided, new ones still arrive through onfile
+        self.listen.clear()
         if firstStart:
             print(f'{bcolors.OKBLUE}### ### ###')
             print('Downloading the room has finished. Leave this running to download new files/log')
             print(f'### ### ###{bcolors.ENDC}')
 
+    def release_file(self, f) -> None:
+        """Drop a decided file from volapi's file list, only its FileRecord is kept if it is downloaded"""
+        self.listen.filedict = f.fid, None
+
     def download_file(self, url, download_path) -> bool:
         """ Downloads a file from volafile and shows a progress bar
+        Waits for a free slot of the transfer controller and reports the throughput to it
         Returns False if there was an error """
-        chunk_size = 1024
-        try:
-            r = requests.get(url, stream=True, headers=self.headers, cookies=self.cookies)
-            r.raise_for_status()
-            if not r:
+        with self.transfers.controller.transfer() as transfer:
+            if self.transfers.cancelled:
                 return False
-            total_size = int(r.headers.get("content-length", 0))
-            temp_path = download_path.with_suffix(download_path.suffix + ".part")
-            with temp_path.open("wb") as fl:
-                for data in tqdm(iterable=r.iter_content(chunk_size=chunk_size), total=total_size / chunk_size,
-                                 unit="KB", unit_scale=True):
-                    fl.write(data)
-            temp_path.rename(download_path)
-            return True
-        except Exception as ex:
-            print("[-] Error: " + str(ex))
-            return False
+            try:
+                with self.transfers.session.get(url, stream=True, headers=self.headers, cookies=self.cookies) as r:
+                    r.raise_for_status()
+                    if not r:
+                        transfer.failed = True
+                        return False
+                    total_size = int(r.headers.get("content-length", 0))
+                    temp_path = download_path.with_suffix(download_path.suffix + ".part")
+                    with temp_path.open("wb") as fl, \
+                            self.transfers.progress(download_path.name, total_size) as progress:
+                        while True:
+                            if self.transfers.cancelled:
+                                # the .part file gets overwritten by the next attempt
+                                return False
+                            data = r.raw.read(transfer.chunk_size, decode_content=True)
+                            if not data:
+                                break
+                            fl.write(data)
+                            transfer.record(len(data))
+                            progress(len(data))
+                temp_path.rename(download_path)
+                self.log_decision()
+                return True
+            except Exception as ex:
+                transfer.failed = True
+                print("[-] Error: " + str(ex))
+                return False
+
+    def log_decision(self) -> None:
+        """Print the transfer controller's newest decision if it changed something"""
+        d = self.transfers.controller.last_decision()
+        if d is None or d is self.last_decision:
+            return
+        self.last_decision = d
+        if d.reason in {"increase", "decrease", "errors"}:
+            st = short_time()
+            print(f'{bcolors.OKTEAL}[{st}] Transfers: {d.transfers} ({d.reason}), read size: {d.chunk_size // 1024} KB, '
+                  f'{d.rate / 1048576:.2f} MB/s, errors: {d.error_rate:.0%}{bcolors.ENDC}')
 
     def manual_single_file_download(self, f) -> bool:
-        """Returns False if there was an error"""
+        """Queues the file for download, returns False if it was not queued"""
         file_name = Path(f.url).name
         download_path = f.subfolder / file_name
         download_path.parent.mkdir(parents=True, exist_ok=True)
 
-        if self.duplicate and download_path.is_file():
+        if self.transfers.is_pending(f.url):
+            print(f"{bcolors.WARNING}File is being downloaded already!{bcolors.ENDC}")
+            return False
+        # files that are still being downloaded count as existing
+        exists = download_path.is_file() or self.transfers.is_pending(str(download_path))
+        if self.duplicate and exists:
             print(f"{bcolors.WARNING}File exists already!{bcolors.ENDC}")
             return False
-        elif download_path.is_file():
+        elif exists:
             new_name = download_path.stem + "-" + VolaDL.id_generator() + download_path.suffix
             download_path = download_path.with_name(new_name)
+        if self.transfers.submit((f.url, str(download_path)), self.download_file, f.url, download_path) is None:
+            return False
         self.counter += 1
         print(f'[{self.counter}] Downloading to: {download_path}')
-        return self.download_file(f.url, download_path)
+        return True
 
 
     def parse_download_path(self, path: str, f):
@@ -244,6 +311,15 @@ class VolaDL(object):
             already_downloaded = True
         if already_downloaded:
             return True
+        if self.near_duplicate_policy != "download" and unified_duplicate_checker.is_near_duplicate_file(f):
+            if self.near_duplicate_policy == "defer":
+                if self.log_deferred(f):
+                    print(f'{bcolors.WARNING}  Unified Duplicate Checker: File is a near duplicate, deferred{bcolors.ENDC}')
+                elif not quiet:
+                    print(f'{bcolors.WARNING}  Unified Duplicate Checker: File is a near duplicate, deferred already{bcolors.ENDC}')
+            else:
+                print(f'{bcolors.FAIL}  Unified Duplicate Checker: File is a near duplicate{bcolors.ENDC}')
+            return True
 
         f.subfolder = self.parse_download_path(self.download_path, f)
         if self.myjdownloader or self.jdownloader:
@@ -266,17 +342,35 @@ class VolaDL(object):
         with self.jd_logpath.open("a", encoding="utf-8") as f:
             f.write(url + '\n')
 
+    def log_deferred(self, f) -> bool:
+        """Write a near duplicate to the deferred manifest so it can be checked and downloaded later
+        Returns False if the file is in the deferred manifest already"""
+        if f.url in self.deferred_urls:
+            return False
+        self.deferred_urls.add(f.url)
+        self.deferred_logpath.parent.mkdir(parents=True, exist_ok=True)
+        append_manifest(self.deferred_logpath, [f])
+        return True
+
     def log_file(self, f) -> None:
-        self.jd_downloaded_urls.append(f.url)
+        self.jd_downloaded_urls.add(f.url)
         unified_duplicate_checker.log_file(f.name, f.size, f.checksum)
         self.log_url(f.url)
 
     def get_logged_urls(self, path):
-        """Retrieve the room's logged urls so we don't download them again"""
+        """Retrieve the room's most recently logged urls so we don't download them again"""
         if path.is_file():
             with path.open("r", encoding="utf-8") as f:
-                return list(set(f.read().splitlines()))
-        return []
+                return LRUSet((line.rstrip("\n") for line in f), maxsize=config.DOWNLOADED_URLS_CACHE)
+        return LRUSet(maxsize=config.DOWNLOADED_URLS_CACHE)
+
+    def get_deferred_urls(self, path):
+        """Retrieve the most recently deferred urls of the room so they are not deferred again after a reconnect"""
+        if path.is_file():
+            with path.open("r", newline='', encoding="utf-8") as f:
+                return LRUSet((row["url"] for row in csv.DictReader(f) if row.get("url")),
+                              maxsize=config.DOWNLOADED_URLS_CACHE)
+        return LRUSet(maxsize=config.DOWNLOADED_URLS_CACHE)
 
     def config_check(self):
         """Checks filter configs for validity and prepares them for filtering"""
@@ -378,10 +472,24 @@ class VolaDL(object):
         return r
 
     def close(self):
-        """only closes the current session, afterwards the downloader reconnects"""
-        print("Closing current instance")
-        self.listen.close()
-        del self.listen
+        """only closes the current session, afterwards the downloader reconnects
+        Releases the room, JDownloader and HTTP connections, can be called more than once"""
+        if self.closed:
+            return ""
+        self.closed = True
+        if self.listen is not None:
+            print("Closing current instance")
+            self.listen.clear()
+            self.listen.close()
+            self.listen = None
+        if self.jdcore is not None:
+            self.jdcore.close()
+            self.jdcore = None
+        if self.own_transfers:
+            # queued downloads still finish, wait for them off the listener thread
+            threading.Thread(target=self.transfers.close).start()
+        self.jd_downloaded_urls.clear()
+        self.deferred_urls.clear()
         return ""
 
     @staticmethod
@@ -438,19 +546,30 @@ def parse_args():
 
 if __name__ == "__main__":
     a = parse_args()
-    lister = [a.room, a.passwd, a.downloader, a.logger, a.myjdownloader, a.jdownloader, a.folder]
+    # downloads and their limits are shared by all reconnects
+    transfers = TransferPool.from_config()
+    lister = [a.room, a.passwd, a.downloader, a.logger, a.myjdownloader, a.jdownloader, a.folder, transfers]
     firstStart = True
-    while True:
-        print(f"{bcolors.OKGREEN}Creating VolaDL object{bcolors.ENDC}")
-        try:
-            v = VolaDL(*lister)
-
-            if a.username:
-                v.vola_user = a.username
-
-            v.dl(firstStart=firstStart)
-        except VolaDLException as err:
-            if err.kill:
-                break
-        firstStart = False
+    try:
+        while True:
+            print(f"{bcolors.OKGREEN}Creating VolaDL object{bcolors.ENDC}")
+            v = None
+            try:
+                v = VolaDL(*lister)
+
+                if a.username:
+                    v.vola_user = a.username
+
+                v.dl(firstStart=firstStart)
+            except VolaDLException as err:
+                if err.kill:
+                    break
+            finally:
+                # tear the old instance down before the next one connects
+                if v is not None:
+                    v.close()
+            firstStart = False
+    finally:
+        # the loop only ends on Ctrl-C or a kill, queued downloads are dropped and running ones stopped
+        transfers.close(cancel=True)
 
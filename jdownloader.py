@@ -28,6 +28,16 @@ class JDownloaderCore:
         self.jd.update_devices()
         self.jdDevice = self.jd.get_device(config.jdownloader_devicename)
 
+    def close(self):
+        """Disconnect from My.JDownloader and drop the device"""
+        if self.myjd and getattr(self, "jd", None) is not None:
+            try:
+                self.jd.disconnect()
+            except myjdapi.myjdapi.MYJDException:
+                pass
+        self.jd = None
+        self.jdDevice = None
+
     def jd_reconnect(self):
         try:
             self.jd.reconnect()
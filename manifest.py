@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Manifest driven batch mode.
+
+export:   joins a room once and writes the metadata of all its files to a manifest (CSV)
+download: downloads the files of one or more manifests without joining a room
+
+Every finished file gets appended to a .state file next to the first manifest,
+a restarted batch skips those files and continues with the rest.
+"""
+from concurrent.futures import as_completed
+from pathlib import Path
+import argparse
+import csv
+import sys
+import time
+
+from tqdm import tqdm
+
+import config
+from theme import bcolors
+import unified_duplicate_checker
+from downloader import VolaDL, VolaDLException
+from throughput import TransferPool
+from records import FileRecord, append_manifest
+
+# results that don't need another attempt when the batch gets restarted
+# deferred files are retried, a later run with --policy download fetches them
+FINAL_RESULTS = {"downloaded", "exists", "duplicate", "near duplicate", "filtered", "too big"}
+
+
+def export_room(room, password, path):
+    """Write the metadata of all files in a room to a manifest
+    Files whose checksum can't be fetched are written without one"""
+    # the near duplicate index is not needed to list the files
+    v = VolaDL(room, password, downloader=False, logger=False, myjdownloader=False, jdownloader=False,
+               near_duplicate_policy="download")
+    try:
+        v.listen = v.create_room()
+        time.sleep(2)
+        files = []
+        missing = 0
+        for f in v.listen.files:
+            try:
+                # every checksum is a separate file info request to volafile
+                files.append(FileRecord.from_file(f))
+            except Exception as ex:
+                print(f'{bcolors.WARNING}No checksum for {f.name}: {ex}{bcolors.ENDC}')
+                missing += 1
+                files.append(FileRecord(f.room.name, f.url, f.name, f.size, "", f.uploader, f.filetype,
+                                        f.expire_time))
+    finally:
+        v.close()
+    path = Path(path)
+    path.unlink(missing_ok=True)
+    append_manifest(path, files)
+    print(f'{bcolors.OKGREEN}Exported {len(files)} files to {path}{bcolors.ENDC}')
+    if missing:
+        print(f'{bcolors.WARNING}{missing} files have no checksum, their duplicates are only found by name and size'
+              f'{bcolors.ENDC}')
+
+
+def read_manifests(paths):
+    """Returns the files of all manifests, every url only once, and {key: error} of rows that can't be used"""
+    files = {}
+    invalid = {}
+    for path in paths:
+        with Path(path).open("r", newline='', encoding="utf-8") as fl:
+            reader = csv.DictReader(fl)
+            for row in reader:
+                key = row.get("url") or f"{path}:{reader.line_num}"
+                try:
+                    files.setdefault(key, FileRecord.from_row(row))
+                except (KeyError, TypeError, ValueError) as ex:
+                    invalid[key] = f"{type(ex).__name__}: {ex}"
+    return list(files.values()), invalid
+
+
+def read_state(path):
+    """Returns {url: result} of a previous run"""
+    state = {}
+    if path.is_file():
+        with path.open("r", newline='', encoding="utf-8") as fl:
+            for row in csv.reader(fl):
+                if len(row) == 2:
+                    state[row[0]] = row[1]
+    return state
+
+
+def prepare(v, f, checksums, queued):
+    """Runs the checks of the listener on a manifest file
+    checksums and queued (a NearDuplicateIndex) hold the files of this batch that are downloaded already,
+    they get logged only after their download finished
+    Returns a result if the file doesn't get downloaded, otherwise the download path"""
+    if v.max_file_size > -1 and f.size / 1048576 >= v.max_file_size:
+        return "too big"
+    if not v.file_check(f):
+        return "filtered"
+    if f.url in v.jd_downloaded_urls or unified_duplicate_checker.is_duplicate_file(f) \
+            or (f.checksum and f.checksum in checksums):
+        return "duplicate"
+    if v.near_duplicate_policy != "download" and (
+            unified_duplicate_checker.is_near_duplicate_file(f) or queued.probably_seen(f.name, f.size)):
+        if v.near_duplicate_policy == "defer":
+            v.log_deferred(f)
+            return "deferred"
+        return "near duplicate"
+    f.subfolder = v.parse_download_path(v.download_path, f)
+    download_path = f.subfolder / Path(f.url).name
+    if download_path.is_file():
+        return "exists"
+    download_path.parent.mkdir(parents=True, exist_ok=True)
+    if f.checksum:
+        checksums.add(f.checksum)
+    queued.add(f.name, f.size)
+    return download_path
+
+
+def batch_download(paths, folder=None, policy=None):
+    """Download the files of the manifests in parallel
+    policy overrides the near duplicate policy of the rooms
+    Returns a list of (url, name, result) in the order of the manifests"""
+    files, invalid = read_manifests(paths)
+    state_path = Path(paths[0]).with_suffix(".state")
+    state = read_state(state_path)
+    transfers = TransferPool.from_config()
+    rooms = {}
+    results = {}
+    todo = []
+    for f in files:
+        if state.get(f.url) in FINAL_RESULTS:
+            results[f.url] = state[f.url]
+            continue
+        v = rooms.get(f.room.name)
+        if v is None:
+            v = VolaDL(f.room.name, None, myjdownloader=False, jdownloader=False, folder=folder, transfers=transfers,
+                       near_duplicate_policy=policy)
+            rooms[f.room.name] = v
+        todo.append((v, f))
+    if results:
+        print(f'{bcolors.OKBLUE}Skipping {len(results)} files finished in a previous run{bcolors.ENDC}')
+
+    checksums = set()
+    queued = unified_duplicate_checker.NearDuplicateIndex(
+        config.NEAR_DUPLICATE_SIMILARITY, config.NEAR_DUPLICATE_SIZE_TOLERANCE, max(len(todo), 1))
+    try:
+        with state_path.open("a", newline='', encoding="utf-8") as state_file, \
+                tqdm(total=len(todo) + len(invalid), unit="file", position=0) as bar:
+            writer = csv.writer(state_file)
+
+            def finish(url, result):
+                results[url] = result
+                writer.writerow([url, result])
+                state_file.flush()
+                bar.update(1)
+
+            for key, error in invalid.items():
+                print(f'{bcolors.FAIL}Invalid manifest row {key}: {error}{bcolors.ENDC}')
+                finish(key, "invalid")
+
+            futures = {}
+            for v, f in todo:
+                try:
+                    download_path = prepare(v, f, checksums, queued)
+                except Exception as ex:
+                    print(f'{bcolors.FAIL}[-] Error: {f.url}: {ex}{bcolors.ENDC}')
+                    finish(f.url, "failed")
+                    continue
+                if isinstance(download_path, str):
+                    finish(f.url, download_path)
+                    continue
+                future = transfers.submit((f.url, str(download_path)), v.download_file, f.url, download_path)
+                if future is None:
+                    finish(f.url, "duplicate")
+                else:
+                    futures[future] = (v, f)
+            for future in as_completed(futures):
+                v, f = futures[future]
+                try:
+                    ok = future.result()
+                    if ok:
+                        v.log_file(f)
+                except Exception as ex:
+                    print(f'{bcolors.FAIL}[-] Error: {f.url}: {ex}{bcolors.ENDC}')
+                    ok = False
+                finish(f.url, "downloaded" if ok else "failed")
+    except KeyboardInterrupt:
+        # drop the queued downloads and stop the running ones, the state file has every finished file
+        transfers.close(cancel=True)
+        raise
+    for v in rooms.values():
+        v.close()
+    transfers.close()
+    report = [(f.url, f.name, results.get(f.url, "failed")) for f in files]
+    report += [(key, "", "invalid") for key in invalid]
+    return report
+
+
+def print_report(report):
+    """Prints the result of every file, returns the number of failed and invalid files"""
+    colors = {"downloaded": bcolors.OKGREEN, "failed": bcolors.FAIL, "invalid": bcolors.FAIL}
+    counts = {}
+    for url, name, result in report:
+        counts[result] = counts.get(result, 0) + 1
+        print(f'{colors.get(result, bcolors.WARNING)}{result:>15}{bcolors.ENDC}  {url}  {name}')
+    print(f'{bcolors.OKBLUE}### ' + ', '.join(f'{k}: {c}' for k, c in sorted(counts.items())) + bcolors.ENDC)
+    return counts.get("failed", 0) + counts.get("invalid", 0)
+
+
+def parse_args():
+    """Parses user arguments"""
+    parser = argparse.ArgumentParser(description="volafile batch downloader")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="Write the file list of a room to a manifest")
+    export.add_argument('--room', '-r', type=str, required=True,
+                        help='Room name, as in https://volafile.org/r/ROOMNAME')
+    export.add_argument('--passwd', '-p', type=str,
+                        help='Room password to enter the room.')
+    export.add_argument('--output', '-o', type=str, required=True,
+                        help='Manifest file to write')
+    download = sub.add_parser("download", help="Download the files of one or more manifests")
+    download.add_argument('manifests', type=str, nargs='+',
+                          help='Manifest files, the state of the run is kept next to the first one')
+    download.add_argument('--folder', '-f', type=str,
+                          help='Folder to place downloads in')
+    download.add_argument('--policy', type=str, choices=unified_duplicate_checker.POLICIES,
+                          help='Near duplicate policy for all rooms, use download for deferred manifests')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    a = parse_args()
+    try:
+        if a.command == "export":
+            export_room(a.room, a.passwd, a.output)
+        else:
+            sys.exit(1 if print_report(batch_download(a.manifests, a.folder, a.policy)) else 0)
+    except VolaDLException:
+        sys.exit(1)
@@ -0,0 +1,100 @@
+"""
+Compact state for long running rooms.
+
+Once a file is decided only a FileRecord of it is kept instead of the volapi
+file object, and caches of seen urls are bounded LRU sets.
+"""
+from collections import OrderedDict
+from pathlib import Path
+import csv
+
+# columns of a manifest, see manifest.py
+FIELDS = ["room", "url", "name", "size", "checksum", "uploader", "filetype", "expire_time"]
+
+
+class RoomRecord:
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FileRecord:
+    """Stands in for a volapi file, has everything the filters, path parsing and downloaders need"""
+    __slots__ = ("room", "url", "name", "size", "checksum", "uploader", "filetype", "expire_time", "subfolder")
+
+    def __init__(self, room, url, name, size, checksum, uploader, filetype, expire_time):
+        self.room = RoomRecord(room)
+        self.url = url
+        self.name = name
+        self.size = int(size)
+        self.checksum = checksum
+        self.uploader = uploader
+        self.filetype = filetype
+        self.expire_time = float(expire_time)
+        self.subfolder = None
+
+    @classmethod
+    def from_file(cls, f):
+        """Copy what is needed from a volapi file"""
+        return cls(f.room.name, f.url, f.name, f.size, f.checksum, f.uploader, f.filetype, f.expire_time)
+
+    @classmethod
+    def from_row(cls, row):
+        """Create a record from a manifest row"""
+        return cls(row["room"], row["url"], row["name"], row["size"], row["checksum"], row["uploader"],
+                   row["filetype"], row["expire_time"])
+
+    def as_row(self) -> dict:
+        """Returns the record as a manifest row"""
+        return {
+            "room": self.room.name,
+            "url": self.url,
+            "name": self.name,
+            "size": self.size,
+            "checksum": self.checksum,
+            "uploader": self.uploader,
+            "filetype": self.filetype,
+            "expire_time": self.expire_time,
+        }
+
+
+def append_manifest(path: Path, records) -> None:
+    """Append records to a manifest, the header gets written if the file is new"""
+    new = not path.is_file()
+    with path.open("a", newline='', encoding="utf-8") as fl:
+        writer = csv.DictWriter(fl, fieldnames=FIELDS)
+        if new:
+            writer.writeheader()
+        for record in records:
+            writer.writerow(record.as_row())
+
+
+class LRUSet:
+    """Set that forgets the least recently used entries beyond maxsize"""
+    def __init__(self, iterable=(), maxsize=100000):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        for item in iterable:
+            self.add(item)
+
+    def __contains__(self, item):
+        if item in self._items:
+            self._items.move_to_end(item)
+            return True
+        return False
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def add(self, item):
+        self._items[item] = None
+        self._items.move_to_end(item)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
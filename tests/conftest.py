@@ -0,0 +1,21 @@
+import sys
+from pathlib import Path
+
+# the modules live in the repository root, there is no package to install
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pytest
+
+import config
+import unified_duplicate_checker
+
+
+@pytest.fixture
+def logs(tmp_path, monkeypatch):
+    """Keep logs, duplicate log and downloads of a test in its tmp_path"""
+    monkeypatch.setattr(config, "LOG_PATH", str(tmp_path / "logs"))
+    monkeypatch.setattr(config, "DOWNLOAD_PATH", str(tmp_path / "downloads" / "{ROOM}"))
+    monkeypatch.setattr(unified_duplicate_checker, "unified_duplicate_log", tmp_path / "unified-duplicate-log.txt")
+    monkeypatch.setattr(unified_duplicate_checker, "_near_index", None)
+    (tmp_path / "logs").mkdir()
+    return tmp_path / "logs"
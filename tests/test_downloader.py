@@ -0,0 +1,117 @@
+import csv
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+import threading
+import time
+
+import pytest
+
+import config
+import downloader
+import unified_duplicate_checker
+from records import FileRecord
+from throughput import TransferController, TransferPool
+
+
+def make_record(url="https://volafile.org/get/abc/file.mkv", name="file.mkv"):
+    return FileRecord("room", url, name, 1000, "d41d8cd98f00b204e9800998ecf8427e", "bob", "video", 1.7e9)
+
+
+def test_invalid_near_duplicate_policy_kills(logs, monkeypatch):
+    monkeypatch.setattr(config, "NEAR_DUPLICATE_POLICY", ["sikp"])
+    with pytest.raises(downloader.VolaDLException) as err:
+        downloader.VolaDL("room", None, jdownloader=False, myjdownloader=False)
+    assert err.value.kill
+
+
+def test_deferred_files_are_a_manifest(logs, monkeypatch):
+    monkeypatch.setattr(config, "NEAR_DUPLICATE_POLICY", ["defer"])
+    unified_duplicate_checker.log_file("file [720p].mkv", 1000, "other checksum")
+    v = downloader.VolaDL("room", None, jdownloader=False, myjdownloader=False)
+    try:
+        assert v.single_file_download(make_record(), quiet=True)
+    finally:
+        v.close()
+    with (Path(logs) / "[room] deferred.csv").open(newline='', encoding="utf-8") as fl:
+        rows = list(csv.DictReader(fl))
+    assert len(rows) == 1
+    assert FileRecord.from_row(rows[0]).url == "https://volafile.org/get/abc/file.mkv"
+
+
+def test_files_are_deferred_once(logs, monkeypatch):
+    monkeypatch.setattr(config, "NEAR_DUPLICATE_POLICY", ["defer"])
+    unified_duplicate_checker.log_file("file [720p].mkv", 1000, "other checksum")
+    # every reconnect goes through the whole room again
+    for _ in range(2):
+        v = downloader.VolaDL("room", None, jdownloader=False, myjdownloader=False)
+        try:
+            v.single_file_download(make_record(), quiet=True)
+            v.single_file_download(make_record(), quiet=True)
+        finally:
+            v.close()
+    with (Path(logs) / "[room] deferred.csv").open(newline='', encoding="utf-8") as fl:
+        assert len(list(csv.DictReader(fl))) == 1
+
+
+def test_running_downloads_are_not_queued_twice(logs, tmp_path, monkeypatch):
+    gate = threading.Event()
+    transfers = TransferPool(TransferController())
+    first = downloader.VolaDL("room", None, jdownloader=False, myjdownloader=False, transfers=transfers)
+    # a reconnect while the download of the first instance is still running
+    second = downloader.VolaDL("room", None, jdownloader=False, myjdownloader=False, transfers=transfers)
+    for v in (first, second):
+        monkeypatch.setattr(v, "download_file", lambda url, path: gate.wait())
+    f = make_record()
+    f.subfolder = tmp_path / "downloads"
+    assert first.manual_single_file_download(f)
+    first.close()
+    assert not second.manual_single_file_download(f)
+    other = make_record(url="https://volafile.org/get/xyz/file.mkv")
+    other.subfolder = f.subfolder
+    # same file name from another url gets an altered name instead of sharing the .part file
+    second.duplicate = False
+    assert second.manual_single_file_download(other)
+    gate.set()
+    second.close()
+    transfers.close()
+
+
+@pytest.fixture
+def slow_server():
+    """Serves a file that takes minutes to download"""
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(100 * 1024 * 1024))
+            self.end_headers()
+            try:
+                while True:
+                    self.wfile.write(b"x" * 1024)
+                    time.sleep(0.01)
+            except OSError:
+                pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_cancel_stops_running_and_queued_downloads(logs, tmp_path, slow_server):
+    transfers = TransferPool(TransferController(min_transfers=2, max_transfers=2))
+    v = downloader.VolaDL("room", None, jdownloader=False, myjdownloader=False, transfers=transfers)
+    futures = [transfers.submit((i,), v.download_file, f"{slow_server}/get/{i}/file.bin", tmp_path / f"{i}.bin")
+               for i in range(6)]
+    time.sleep(0.5)
+    start = time.monotonic()
+    transfers.close(cancel=True)
+    assert time.monotonic() - start < 5
+    assert all(fut.done() for fut in futures)
+    assert sum(fut.cancelled() for fut in futures) >= 4
+    assert not any(fut.result() for fut in futures if not fut.cancelled())
+    v.close()
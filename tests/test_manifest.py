@@ -0,0 +1,131 @@
+import csv
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+
+import pytest
+
+import manifest
+from records import FIELDS
+
+CONTENT = b"volafile" * 1000
+
+
+@pytest.fixture
+def server():
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(CONTENT)))
+            self.end_headers()
+            self.wfile.write(CONTENT)
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def row(url, name, checksum, size=len(CONTENT)):
+    return {"room": "room", "url": url, "name": name, "size": size, "checksum": checksum,
+            "uploader": "bob", "filetype": "other", "expire_time": 1.7e9}
+
+
+def write_manifest(path, rows):
+    with path.open("w", newline='', encoding="utf-8") as fl:
+        writer = csv.DictWriter(fl, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def test_batch_download(logs, tmp_path, server):
+    path = tmp_path / "manifest.csv"
+    write_manifest(path, [
+        row(f"{server}/get/a/first.bin", "first.bin", "aaaa"),
+        row(f"{server}/get/b/same.bin", "same.bin", "aaaa"),
+        row(f"{server}/get/c/broken.bin", "broken.bin", "cccc", size=""),
+        row(f"{server}/get/d/second.bin", "second.bin", "dddd"),
+    ])
+    report = {url: result for url, _, result in manifest.batch_download([str(path)])}
+    assert report == {
+        f"{server}/get/a/first.bin": "downloaded",
+        f"{server}/get/b/same.bin": "duplicate",
+        f"{server}/get/c/broken.bin": "invalid",
+        f"{server}/get/d/second.bin": "downloaded",
+    }
+    assert (tmp_path / "downloads" / "room" / "first.bin").read_bytes() == CONTENT
+    assert not (tmp_path / "downloads" / "room" / "same.bin").exists()
+
+    # a restarted run keeps the finished files and only retries the rest
+    report = {url: result for url, _, result in manifest.batch_download([str(path)])}
+    assert report[f"{server}/get/a/first.bin"] == "downloaded"
+    assert report[f"{server}/get/c/broken.bin"] == "invalid"
+    with path.with_suffix(".state").open(newline='') as fl:
+        retried = [url for url, _ in csv.reader(fl)]
+    assert retried.count(f"{server}/get/a/first.bin") == 1
+    assert retried.count(f"{server}/get/c/broken.bin") == 2
+
+
+def test_near_duplicates_in_the_same_batch(logs, tmp_path, server, monkeypatch):
+    monkeypatch.setattr(manifest.config, "NEAR_DUPLICATE_POLICY", ["skip"])
+    path = tmp_path / "manifest.csv"
+    write_manifest(path, [
+        row(f"{server}/get/a/show-720.bin", "Show S01E01 [720p].bin", "aaaa"),
+        row(f"{server}/get/b/show-1080.bin", "Show S01E01 [1080p].bin", "bbbb"),
+        row(f"{server}/get/c/show-e02.bin", "Show S01E02 [720p].bin", "cccc"),
+    ])
+    report = [result for _, _, result in manifest.batch_download([str(path)])]
+    assert report == ["downloaded", "near duplicate", "downloaded"]
+
+
+def test_deferred_manifest(logs, tmp_path, server, monkeypatch):
+    monkeypatch.setattr(manifest.config, "NEAR_DUPLICATE_POLICY", ["defer"])
+    path = tmp_path / "manifest.csv"
+    write_manifest(path, [
+        row(f"{server}/get/a/show-720.bin", "Show S01E01 [720p].bin", "aaaa"),
+        row(f"{server}/get/b/show-1080.bin", "Show S01E01 [1080p].bin", "bbbb"),
+    ])
+    assert [result for _, _, result in manifest.batch_download([str(path)])] == ["downloaded", "deferred"]
+    deferred = logs / "[room] deferred.csv"
+
+    # with the room's policy the files stay deferred and are not written to the manifest again
+    assert [result for _, _, result in manifest.batch_download([str(deferred)])] == ["deferred"]
+    with deferred.open(newline='', encoding="utf-8") as fl:
+        assert len(list(csv.DictReader(fl))) == 1
+
+    assert [result for _, _, result in manifest.batch_download([str(deferred)], policy="download")] == ["downloaded"]
+    assert (tmp_path / "downloads" / "room" / "show-1080.bin").read_bytes() == CONTENT
+
+
+class FakeFile:
+    def __init__(self, name, timeout=False):
+        self.room = type("Room", (), {"name": "room"})()
+        self.url = f"https://volafile.org/get/{name}/{name}.bin"
+        self.name = f"{name}.bin"
+        self.size = 1000
+        self.uploader = "bob"
+        self.filetype = "other"
+        self.expire_time = 1.7e9
+        self.timeout = timeout
+
+    @property
+    def checksum(self):
+        if self.timeout:
+            raise ValueError("getFileinfo timed out")
+        return f"{self.name}-md5"
+
+
+def test_export_writes_files_without_checksum(logs, tmp_path, monkeypatch):
+    monkeypatch.setattr(manifest.config, "NEAR_DUPLICATE_POLICY", ["skip"])
+    room = type("Room", (), {"files": [FakeFile("a"), FakeFile("b", timeout=True)], "clear": lambda self: None,
+                             "close": lambda self: None})()
+    monkeypatch.setattr(manifest.VolaDL, "create_room", lambda self: room)
+    monkeypatch.setattr(manifest.time, "sleep", lambda seconds: None)
+    path = tmp_path / "export.csv"
+    manifest.export_room("room", None, path)
+    with path.open(newline='', encoding="utf-8") as fl:
+        assert [r["checksum"] for r in csv.DictReader(fl)] == ["a.bin-md5", ""]
+    assert manifest.unified_duplicate_checker._near_index is None
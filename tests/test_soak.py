@@ -0,0 +1,179 @@
+"""
+Soak test for long running listeners: a fake room uploads files for many
+simulated days, every day ends with a reconnect like in __main__, and the
+memory traced by tracemalloc must not grow with the number of days.
+"""
+import contextlib
+import gc
+import os
+import pathlib
+import tracemalloc
+from datetime import timedelta
+
+import pytest
+
+import config
+import downloader
+import unified_duplicate_checker
+
+FILES_PER_DAY = 15
+WARMUP_DAYS = 10
+DAYS = 40
+
+
+class FakeFile:
+    """Looks like a volapi file, the payload makes leaked files easy to see"""
+    def __init__(self, room, number):
+        self.room = room
+        self.fid = f"fid{number}"
+        self.url = f"https://volafile.org/get/{self.fid}/file{number}.mkv"
+        self.name = f"Show {number} [720p].mkv"
+        self.size = 1000000 + number
+        if number % 5 == 4:
+            # every fifth file is a re-upload of the one before
+            self.name = f"[Re-Up] Show {number - 1} (1080p).mkv"
+            self.size -= 1
+        self.checksum = f"{number:032x}"
+        self.uploader = "bob"
+        self.filetype = "video"
+        self.expire_time = 1.7e9
+        self.payload = bytearray(4096)
+
+
+class FakeRoom:
+    """Stands in for volapi.Room, listen() emits one day of file events and a time event
+
+    Like the connection threads of volapi, open_rooms keeps every room that was
+    not closed alive, together with the listeners and the VolaDL behind them.
+    """
+    uploaded = 0
+    largest_filedict = 0
+    files_per_day = FILES_PER_DAY
+    open_rooms = set()
+    snapshots = {}
+
+    def __init__(self, name, user=None, password=None, key=None):
+        FakeRoom.open_rooms.add(self)
+        self.name = name
+        self.user = user
+        self.connected = True
+        self.listeners = {}
+        self._files = {}
+        # the files of the last day are still in the room after the reconnect
+        for n in range(max(FakeRoom.uploaded - FILES_PER_DAY, 0), FakeRoom.uploaded):
+            f = FakeFile(self, n)
+            self._files[f.fid] = f
+
+    @property
+    def files(self):
+        return list(self._files.values())
+
+    @property
+    def filedict(self):
+        return self._files
+
+    @filedict.setter
+    def filedict(self, kv):
+        k, v = kv
+        if v is None:
+            self._files.pop(k, None)
+        else:
+            self._files[k] = v
+
+    def add_listener(self, event_type, callback):
+        self.listeners[event_type] = callback
+
+    def listen(self):
+        for i in range(self.files_per_day):
+            f = FakeFile(self, FakeRoom.uploaded)
+            FakeRoom.uploaded += 1
+            self._files[f.fid] = f
+            self.listeners["file"](f)
+            FakeRoom.largest_filedict = max(FakeRoom.largest_filedict, len(self._files))
+            if i in FakeRoom.snapshots:
+                gc.collect()
+                FakeRoom.snapshots[i] = traced(tracemalloc.take_snapshot())
+            if not self.connected:
+                return
+        self.listeners["time"](None)
+
+    def clear(self):
+        self._files.clear()
+
+    def close(self):
+        self.connected = False
+        FakeRoom.open_rooms.discard(self)
+
+
+@pytest.fixture
+def soak(logs, tmp_path, monkeypatch):
+    folderwatch = tmp_path / "folderwatch"
+    folderwatch.mkdir()
+    monkeypatch.setattr(downloader, "Room", FakeRoom)
+    monkeypatch.setattr(downloader.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(config, "JDOWNLOADER_FOLDERWATCH", folderwatch)
+    monkeypatch.setattr(config, "NEAR_DUPLICATE_POLICY", ["skip"])
+    monkeypatch.setattr(config, "NEAR_DUPLICATE_HISTORY", 50)
+    monkeypatch.setattr(config, "DOWNLOADED_URLS_CACHE", 50)
+    monkeypatch.setattr(FakeRoom, "uploaded", 0)
+    monkeypatch.setattr(FakeRoom, "largest_filedict", 0)
+    monkeypatch.setattr(FakeRoom, "open_rooms", set())
+    monkeypatch.setattr(FakeRoom, "snapshots", {})
+
+
+def simulate_day():
+    """One iteration of the reconnect loop in __main__"""
+    v = downloader.VolaDL("soak", None, downloader=True, logger=False, jdownloader=True)
+    v.refresh_delta = timedelta(0)
+    try:
+        v.dl(firstStart=False)
+    finally:
+        v.close()
+
+
+def traced(snapshot):
+    # pathlib interns path parts, that table belongs to the interpreter
+    return sum(stat.size for stat in snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, pathlib.__file__),
+    ]).statistics("filename"))
+
+
+def test_memory_stays_flat(soak):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        tracemalloc.start()
+        try:
+            for _ in range(WARMUP_DAYS):
+                simulate_day()
+            gc.collect()
+            before = traced(tracemalloc.take_snapshot())
+            for _ in range(DAYS):
+                simulate_day()
+            gc.collect()
+            after = traced(tracemalloc.take_snapshot())
+        finally:
+            tracemalloc.stop()
+
+    # a single kept file would already cost its 4 KB payload
+    assert after - before < 32 * 1024, f"grew by {after - before} bytes over {DAYS} days"
+    assert FakeRoom.largest_filedict == 0
+    assert not FakeRoom.open_rooms
+    assert len(unified_duplicate_checker.near_index()) == 50
+    crawljobs = len(list(config.JDOWNLOADER_FOLDERWATCH.iterdir()))
+    assert crawljobs == (WARMUP_DAYS + DAYS) * FILES_PER_DAY * 4 // 5
+
+
+def test_memory_stays_flat_within_a_day(soak, monkeypatch):
+    """A single instance that runs for a long time, the caches have to stay bounded"""
+    monkeypatch.setattr(FakeRoom, "files_per_day", 900)
+    monkeypatch.setattr(FakeRoom, "snapshots", {299: None, 899: None})
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        tracemalloc.start()
+        try:
+            simulate_day()
+        finally:
+            tracemalloc.stop()
+
+    grown = FakeRoom.snapshots[899] - FakeRoom.snapshots[299]
+    assert grown < 32 * 1024, f"grew by {grown} bytes over 600 files"
+    assert FakeRoom.largest_filedict == 0
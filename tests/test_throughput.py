@@ -0,0 +1,126 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import statistics
+import threading
+import time
+
+import pytest
+
+from throughput import TransferController, TransferPool
+
+PER_CONNECTION = 1000000
+TOTAL = 4000000
+FILE_SIZE = 1500000
+BLOCK = 16384
+
+
+class Bandwidth:
+    """Token bucket shared by all connections of the server"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, n):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate * 0.05, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+            time.sleep(0.002)
+
+
+@pytest.fixture
+def capped_server():
+    """HTTP server with 1 MB/s per connection and 4 MB/s in total, 4 transfers are ideal"""
+    bandwidth = Bandwidth(TOTAL)
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(FILE_SIZE))
+            self.end_headers()
+            sent = 0
+            start = time.monotonic()
+            while sent < FILE_SIZE:
+                bandwidth.take(BLOCK)
+                self.wfile.write(b"x" * BLOCK)
+                sent += BLOCK
+                ahead = sent / PER_CONNECTION - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/file"
+    server.shutdown()
+    server.server_close()
+
+
+def download(pool, url):
+    with pool.controller.transfer() as transfer:
+        with pool.session.get(url, stream=True) as r:
+            while True:
+                data = r.raw.read(transfer.chunk_size)
+                if not data:
+                    break
+                transfer.record(len(data))
+
+
+def test_converges_to_bandwidth_cap(capped_server):
+    pool = TransferPool(TransferController(min_transfers=1, max_transfers=8, interval=0.3))
+    stop = time.monotonic() + 20
+    futures = []
+
+    def feed():
+        # keep more downloads queued than the controller can ever allow
+        while time.monotonic() < stop:
+            futures[:] = [fut for fut in futures if not fut.done()]
+            while len(futures) < 12:
+                futures.append(pool.submit((object(),), download, pool, capped_server))
+            time.sleep(0.05)
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    feeder.join()
+    pool.close()
+
+    decisions = [d for d in pool.controller.decisions if d.reason != "idle"]
+    late = decisions[-30:]
+    assert all(3 <= d.transfers <= 5 for d in late), [d.transfers for d in late]
+    assert statistics.median(d.transfers for d in late) == 4
+    assert statistics.mean(d.rate for d in late) > 0.85 * TOTAL
+
+
+def test_pending_keys_are_not_submitted_twice():
+    pool = TransferPool(TransferController())
+    gate = threading.Event()
+    first = pool.submit(("url", "path"), gate.wait)
+    assert first is not None
+    assert pool.is_pending("url")
+    assert pool.submit(("url", "other path"), gate.wait) is None
+    gate.set()
+    first.result()
+    pool.close()
+    assert not pool.is_pending("url")
+
+
+def test_one_progress_bar_for_all_downloads():
+    pool = TransferPool(TransferController())
+    with pool.progress("first.bin", 100) as first:
+        first(40)
+        assert pool._bar.desc.startswith("first.bin")
+        with pool.progress("second.bin", 50) as second:
+            second(25)
+            assert (pool._bar.n, pool._bar.total) == (65, 150)
+            assert pool._bar.desc.startswith("2 downloads")
+        assert pool._bar.desc.startswith("first.bin")
+    assert pool._bar is None
+    pool.close()
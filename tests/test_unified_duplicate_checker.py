@@ -0,0 +1,75 @@
+import pytest
+
+import config
+import unified_duplicate_checker
+from unified_duplicate_checker import NearDuplicateIndex, normalize_file_name
+
+
+def test_normalize_strips_tags_and_resolution():
+    assert normalize_file_name("[Re-Up] My_Show.S01E02.1080p.WEB-DL.x264 [GRP].MKV") == "my show s01e02.mkv"
+    assert normalize_file_name("My Show S01E02 (720p).mkv") == "my show s01e02.mkv"
+
+
+def test_normalize_keeps_years():
+    assert normalize_file_name("Movie (2019).mkv") != normalize_file_name("Movie (1998).mkv")
+
+
+def test_reupload_is_seen():
+    index = NearDuplicateIndex()
+    index.add("My Show S01E02 [720p].mkv", 1000000)
+    assert index.probably_seen("[new] My_Show.S01E02.1080p [GRP].MKV", 1000100)
+    assert index.probably_seen("My Show  S01E02 .mkv", 1000000)
+
+
+def test_size_has_to_match():
+    index = NearDuplicateIndex()
+    index.add("My Show S01E02.mkv", 1000000)
+    assert not index.probably_seen("My Show S01E02.mkv", 2000000)
+
+
+def test_distinct_files_are_not_seen():
+    index = NearDuplicateIndex()
+    pairs = [
+        ("Movie (2019).mkv", "Movie (1998).mkv"),
+        ("Some Long Show Name Season 1 Episode 01.mkv", "Some Long Show Name Season 1 Episode 02.mkv"),
+        ("Linux Kernel Development 3rd Edition.pdf", "Linux Kernel Development 2nd Edition.pdf"),
+    ]
+    for logged, _ in pairs:
+        index.add(logged, 1000000)
+    for _, new in pairs:
+        assert not index.probably_seen(new, 1000000)
+
+
+def test_index_is_bounded():
+    index = NearDuplicateIndex(maxsize=10)
+    for i in range(100):
+        index.add(f"file number {i}.zip", 1000)
+    assert len(index) == 10
+    assert index.probably_seen("file number 99.zip", 1000)
+    assert not index.probably_seen("file number 5.zip", 1000)
+    assert sum(len(b) if isinstance(b, list) else 1 for b in index._buckets.values()) == 10 * index.BANDS
+
+
+def test_policy(monkeypatch):
+    monkeypatch.setattr(config, "NEAR_DUPLICATE_POLICY", ["skip", "download#gentoomen"])
+    assert unified_duplicate_checker.near_duplicate_policy("other") == "skip"
+    assert unified_duplicate_checker.near_duplicate_policy("gentoomen") == "download"
+    monkeypatch.setattr(config, "NEAR_DUPLICATE_POLICY", ["sikp"])
+    with pytest.raises(ValueError):
+        unified_duplicate_checker.near_duplicate_policy("other")
+
+
+def test_episodes_of_a_show_get_their_own_buckets():
+    index = NearDuplicateIndex(maxsize=20000)
+    for i in range(20000):
+        index.add(f"Some Show Name Episode {i} [720p].mkv", 1000000 + i)
+    # names that only differ in their numbers must not pile up in one bucket, lookups would compare all of them
+    assert max(len(b) if isinstance(b, list) else 1 for b in index._buckets.values()) <= 2
+    assert index.probably_seen("[Re-Up] Some Show Name Episode 123 (1080p).mkv", 1000123)
+    assert not index.probably_seen("Some Show Name Episode 20001 [720p].mkv", 1000123)
+
+
+def test_files_without_checksum_are_compared_by_name(logs):
+    unified_duplicate_checker.log_file("first.bin", 1000, "")
+    assert not unified_duplicate_checker.is_duplicate("second.bin", 1000, "")
+    assert unified_duplicate_checker.is_duplicate("[Re-Up] first.bin", 1000, "")
@@ -0,0 +1,300 @@
+"""
+Adaptive concurrency for downloads.
+
+The TransferController decides how many transfers may run at once and how big
+the reads of each transfer are. Both get adjusted in an AIMD style from the
+throughput and the error rate measured over the last interval.
+"""
+
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import threading
+import time
+
+import requests
+from tqdm import tqdm
+
+import config
+
+Decision = namedtuple("Decision", ["time", "reason", "transfers", "chunk_size", "rate", "per_transfer", "error_rate"])
+
+
+class Transfer:
+    """A running transfer, handed out by TransferController.transfer()"""
+    def __init__(self, controller):
+        self.controller = controller
+        self.started = time.monotonic()
+        self.bytes = 0
+        self.failed = False
+
+    @property
+    def chunk_size(self) -> int:
+        return self.controller.chunk_size
+
+    def record(self, nbytes: int) -> None:
+        self.bytes += nbytes
+        self.controller.record(nbytes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.failed = self.failed or exc_type is not None
+        self.controller.release(self)
+        return False
+
+
+class TransferController:
+    """AIMD controller for the number of parallel transfers and their read size
+
+    One more transfer gets probed at a time. After a settle window the mean
+    throughput of the next WINDOWS windows is compared with the mean before the
+    probe, the probe is only kept if it gained GAIN plus the spread of the
+    measurements. Failed probes are undone and the next probe waits twice as
+    long, errors cut the number of transfers back multiplicatively.
+    """
+    # a probe has to improve the throughput by this fraction on top of the measured spread
+    GAIN = 0.05
+    # windows the throughput gets averaged over before a decision
+    WINDOWS = 2
+    # maximum number of windows to wait between probes after failed ones
+    MAX_PROBE_WAIT = 16
+    # multiplicative decrease of transfers on errors
+    BACKOFF = 0.75
+    # error rate above which the controller backs off
+    ERROR_RATE = 0.1
+    # reads should take roughly this long at the measured per-transfer speed
+    CHUNK_SECONDS = 0.05
+
+    def __init__(self, min_transfers=1, max_transfers=6, min_chunk_size=64 * 1024, max_chunk_size=4 * 1024 * 1024,
+                 interval=5.0, history=100):
+        self.min_transfers = min_transfers
+        self.max_transfers = max_transfers
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.interval = interval
+
+        self.transfers = min_transfers
+        self.chunk_size = min_chunk_size
+        self.active = 0
+        self.decisions = deque(maxlen=history)
+
+        self._cond = threading.Condition()
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_done = 0
+        self._window_errors = 0
+        self._window_saturated = False
+        # throughput of the windows since the last change of transfers
+        self._rates = deque(maxlen=self.WINDOWS)
+        self._settle = True
+        self._baseline = None
+        self._probe_wait = 0
+        self._probe_backoff = 1
+
+    def transfer(self) -> Transfer:
+        """Blocks until a transfer slot is free, use as a context manager"""
+        with self._cond:
+            while self.active >= self.transfers:
+                self._cond.wait()
+            self.active += 1
+            self._window_saturated = self._window_saturated or self.active >= self.transfers
+            return Transfer(self)
+
+    def release(self, transfer: Transfer) -> None:
+        with self._cond:
+            self.active -= 1
+            if transfer.failed:
+                self._window_errors += 1
+            else:
+                self._window_done += 1
+            self._maybe_adjust()
+            self._cond.notify_all()
+
+    def record(self, nbytes: int) -> None:
+        with self._cond:
+            self._window_bytes += nbytes
+            self._maybe_adjust()
+
+    @staticmethod
+    def _spread(rates) -> float:
+        return (max(rates) - min(rates)) / 2
+
+    def _change(self, transfers: int) -> None:
+        self.transfers = transfers
+        self._rates.clear()
+        self._settle = True
+
+    def _decide(self, rate: float, error_rate: float) -> str:
+        if error_rate > self.ERROR_RATE:
+            self._change(max(self.min_transfers, min(self.transfers - 1, int(self.transfers * self.BACKOFF))))
+            self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+            self._baseline = None
+            return "errors"
+        if not self._window_saturated:
+            # not enough work to fill the slots, nothing to learn from this window
+            return "idle"
+        if self._settle:
+            # the window right after a change is a mix of both levels
+            self._settle = False
+            return "settle"
+        self._rates.append(rate)
+        if len(self._rates) < self.WINDOWS:
+            return "measure"
+        mean = sum(self._rates) / len(self._rates)
+        if self._baseline is not None:
+            old_mean, old_spread = self._baseline
+            self._baseline = None
+            if mean < old_mean * (1 + self.GAIN) + old_spread + self._spread(self._rates):
+                self._probe_backoff = min(self._probe_backoff * 2, self.MAX_PROBE_WAIT)
+                self._probe_wait = self._probe_backoff
+                self._change(max(self.min_transfers, self.transfers - 1))
+                return "decrease"
+            self._probe_backoff = 1
+            return "keep"
+        if self._probe_wait > 0:
+            self._probe_wait -= 1
+            return "hold"
+        if self.transfers >= self.max_transfers:
+            return "max"
+        self._baseline = (mean, self._spread(self._rates))
+        self._change(self.transfers + 1)
+        return "increase"
+
+    def _maybe_adjust(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.interval:
+            return
+        rate = self._window_bytes / elapsed
+        finished = self._window_done + self._window_errors
+        error_rate = self._window_errors / finished if finished else 0.0
+        per_transfer = rate / max(self.active, 1)
+
+        reason = self._decide(rate, error_rate)
+        if reason != "errors" and rate > 0:
+            target = per_transfer * self.CHUNK_SECONDS
+            if self.chunk_size < target:
+                self.chunk_size = min(self.max_chunk_size, self.chunk_size + self.min_chunk_size)
+            elif self.chunk_size > 2 * target:
+                self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+
+        self.decisions.append(Decision(time.time(), reason, self.transfers, self.chunk_size,
+                                       rate, per_transfer, error_rate))
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_done = 0
+        self._window_errors = 0
+        self._window_saturated = self.active >= self.transfers
+        self._cond.notify_all()
+
+    def last_decision(self):
+        """Returns the newest Decision or None"""
+        with self._cond:
+            return self.decisions[-1] if self.decisions else None
+
+
+class TransferPool:
+    """Download threads, transfer controller and HTTP session of a process
+
+    It outlives the VolaDL instances, so downloads that are still running at a
+    reconnect share the limits with the new instance. Keys (url and download
+    path) of queued and running downloads are kept so nothing gets submitted twice.
+    Downloads check cancelled between their reads to stop early on close(cancel=True).
+    """
+    def __init__(self, controller: TransferController):
+        self.controller = controller
+        self.session = requests.Session()
+        self._executor = ThreadPoolExecutor(max_workers=controller.max_transfers)
+        self._pending = set()
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        # one progress bar for all running downloads, parallel bars garble the terminal
+        self._bar = None
+        self._bar_names = []
+
+    @classmethod
+    def from_config(cls):
+        return cls(TransferController(
+            min_transfers=config.AUTOTUNE_MIN_TRANSFERS,
+            max_transfers=config.AUTOTUNE_MAX_TRANSFERS,
+            min_chunk_size=config.AUTOTUNE_MIN_CHUNK_SIZE,
+            max_chunk_size=config.AUTOTUNE_MAX_CHUNK_SIZE,
+            interval=config.AUTOTUNE_INTERVAL
+        ))
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def is_pending(self, key) -> bool:
+        with self._lock:
+            return key in self._pending
+
+    def submit(self, keys, fn, *args):
+        """Run fn(*args) on a download thread, returns the future or None if one of the keys is pending"""
+        keys = tuple(keys)
+        with self._lock:
+            if any(key in self._pending for key in keys):
+                return None
+            self._pending.update(keys)
+            future = self._executor.submit(self._run, keys, fn, *args)
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _run(self, keys, fn, *args):
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._pending.difference_update(keys)
+
+    def _describe(self) -> None:
+        names = self._bar_names
+        self._bar.set_description(names[0] if len(names) == 1 else f"{len(names)} downloads", refresh=False)
+        self._bar.refresh()
+
+    def _advance(self, nbytes: int) -> None:
+        with self._lock:
+            self._bar.update(nbytes)
+
+    @contextmanager
+    def progress(self, name: str, total: int):
+        """Adds a download to the progress bar, yields a function to report the downloaded bytes"""
+        with self._lock:
+            if self._bar is None:
+                self._bar = tqdm(total=0, unit="B", unit_scale=True, leave=False)
+            self._bar.total += total
+            self._bar_names.append(name)
+            self._describe()
+        try:
+            yield self._advance
+        finally:
+            with self._lock:
+                self._bar_names.remove(name)
+                if self._bar_names:
+                    self._describe()
+                else:
+                    self._bar.close()
+                    self._bar = None
+
+    def _done(self, future) -> None:
+        with self._lock:
+            self._futures.discard(future)
+
+    def join(self) -> None:
+        """Waits for all submitted downloads, Ctrl-C interrupts the wait"""
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+
+    def close(self, cancel=False) -> None:
+        """Waits for all submitted downloads, then closes the HTTP session
+        With cancel queued downloads get dropped and running ones stop after their current read"""
+        if cancel:
+            self._cancelled.set()
+        self._executor.shutdown(wait=True, cancel_futures=cancel)
+        self.session.close()
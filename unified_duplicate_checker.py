@@ -1,11 +1,16 @@
 """
 Stores all file names and sizes in a CSV file.
 
+Near duplicates (re-uploads with different tags, resolution suffixes, whitespace
+or extension case) are found through an in-memory MinHash index over the
+normalized names of the newest NEAR_DUPLICATE_HISTORY entries of the log.
 """
 
 import config
 from pathlib import Path
 import csv
+from array import array
+from collections import deque
 import re
 
 unified_duplicate_log = Path(config.LOG_PATH) / "unified-duplicate-log.txt"
@@ -15,6 +20,8 @@ def log_file(file_name: str, file_size: str, file_md5: str) -> None:
     with unified_duplicate_log.open("a", newline='') as f:
         writer = csv.writer(f)
         writer.writerow([file_name, file_size, file_md5])
+    if _near_index is not None:
+        _near_index.add(file_name, file_size)
 
 def mangle_file_name(file_name: str) -> str:
     file_name = file_name.upper()
@@ -29,7 +36,8 @@ def is_duplicate(file_name: str, file_size: str, file_md5: str) -> bool:
     with unified_duplicate_log.open("r", newline='') as f:
         reader = csv.reader(f)
         for row in reader:
-            if len(row) > 2:
+            # files exported without a checksum are logged with an empty one
+            if len(row) > 2 and row[2]:
                 if file_md5 == row[2]:
                     return True
             elif mfn(file_name) == mfn(row[0]) and str(file_size) == row[1]:
@@ -39,3 +47,174 @@ def is_duplicate(file_name: str, file_size: str, file_md5: str) -> bool:
 def is_duplicate_file(f) -> bool:
     return is_duplicate(f.name, f.size, f.checksum)
 
+
+
+# #### NEAR DUPLICATES
+_normalize_res = [re.compile(r, flags=re.IGNORECASE) for r in config.NEAR_DUPLICATE_NORMALIZE_RE]
+_non_word_re = re.compile(r"[\W_]+")
+_numbers_re = re.compile(r"\d+")
+POLICIES = ("skip", "defer", "download")
+
+def normalize_file_name(file_name: str) -> str:
+    """Reduce a file name to the parts that identify its content"""
+    stem, dot, ext = mfn(file_name).rpartition(".")
+    if not dot or not ext.isalnum():
+        stem, ext = stem + dot + ext, ""
+    stem = stem.replace("_", " ")
+    for reg in _normalize_res:
+        stem = reg.sub(" ", stem)
+    stem = " ".join(_non_word_re.sub(" ", stem).split())
+    if ext:
+        return f"{stem}.{ext}".casefold()
+    return stem.casefold()
+
+class NearDuplicateIndex:
+    """MinHash LSH over character trigrams of normalized file names.
+
+    Every name gets a signature of BANDS * ROWS min hashes. Names with the same
+    numbers sharing all ROWS hashes of any band land in the same bucket, so a
+    lookup only compares against a handful of candidates instead of the whole
+    history, even for the episodes of one show. Only the signatures of the
+    newest maxsize names are kept, older ones get evicted from their buckets.
+    """
+    BANDS = 5
+    ROWS = 3
+
+    def __init__(self, similarity=0.8, size_tolerance=0.01, maxsize=50000):
+        self.similarity = similarity
+        self.size_tolerance = size_tolerance
+        self.maxsize = maxsize
+        self._length = self.BANDS * self.ROWS
+        # ring buffer of the indexed names, slot -> size/numbers key/signature
+        self._sizes = array("q", bytes(8 * maxsize))
+        self._numbers = array("q", bytes(8 * maxsize))
+        self._signatures = array("q", bytes(8 * self._length * maxsize))
+        self._next = 0
+        self._count = 0
+        # band key -> slot, or a list of slots if more than one name shares the bucket
+        self._buckets = {}
+
+    def __len__(self):
+        return self._count
+
+    def _signature(self, name: str) -> list:
+        """One permutation MinHash: every trigram gets hashed once, each bin keeps the smallest hash"""
+        padded = f" {name} "
+        n = self._length
+        sig = [None] * n
+        for h in map(hash, {padded[i:i + 3] for i in range(max(len(padded) - 2, 1))}):
+            b = h % n
+            if sig[b] is None or h < sig[b]:
+                sig[b] = h
+        if None in sig:
+            # empty bins of short names borrow the next filled bin
+            filled = [i for i, h in enumerate(sig) if h is not None]
+            sig = [sig[next((j for j in filled if j > i), filled[0])] if h is None else h for i, h in enumerate(sig)]
+        return sig
+
+    @staticmethod
+    def _numbers_key(name: str) -> int:
+        """Numbers have to match exactly, S01E01 and S01E02 are different files"""
+        return hash(tuple(int(n) for n in _numbers_re.findall(name)))
+
+    def _band_keys(self, numbers: int, sig) -> list:
+        r = self.ROWS
+        return [hash((i, numbers, *sig[i * r:(i + 1) * r])) for i in range(self.BANDS)]
+
+    def _slot_signature(self, slot: int):
+        n = self._length
+        return self._signatures[slot * n:(slot + 1) * n]
+
+    def _size_match(self, size: int, other: int) -> bool:
+        return abs(size - other) <= self.size_tolerance * max(size, other)
+
+    def _evict(self, slot: int) -> None:
+        for key in self._band_keys(self._numbers[slot], self._slot_signature(slot)):
+            bucket = self._buckets[key]
+            if isinstance(bucket, list):
+                # slots get evicted in the order they were added, so it is always the oldest of its bucket
+                del bucket[0]
+                if len(bucket) == 1:
+                    self._buckets[key] = bucket[0]
+            else:
+                del self._buckets[key]
+        self._count -= 1
+
+    def add(self, file_name: str, file_size) -> None:
+        name = normalize_file_name(file_name)
+        slot = self._next
+        self._next = (slot + 1) % self.maxsize
+        if self._count == self.maxsize:
+            self._evict(slot)
+        numbers = self._numbers_key(name)
+        sig = self._signature(name)
+        n = len(sig)
+        self._sizes[slot] = int(file_size)
+        self._numbers[slot] = numbers
+        self._signatures[slot * n:(slot + 1) * n] = array("q", sig)
+        self._count += 1
+        for key in self._band_keys(numbers, sig):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                self._buckets[key] = slot
+            elif isinstance(bucket, list):
+                bucket.append(slot)
+            else:
+                self._buckets[key] = [bucket, slot]
+
+    def probably_seen(self, file_name: str, file_size) -> bool:
+        """True if a similar name with the same numbers and a similar size is in the index
+        The similarity is estimated from the share of equal min hashes of both signatures"""
+        name = normalize_file_name(file_name)
+        size = int(file_size)
+        numbers = self._numbers_key(name)
+        sig = self._signature(name)
+        needed = self.similarity * len(sig)
+        checked = set()
+        for key in self._band_keys(numbers, sig):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                continue
+            for slot in bucket if isinstance(bucket, list) else (bucket,):
+                if slot in checked:
+                    continue
+                checked.add(slot)
+                if self._numbers[slot] != numbers or not self._size_match(size, self._sizes[slot]):
+                    continue
+                if sum(map(int.__eq__, sig, self._slot_signature(slot))) >= needed:
+                    return True
+        return False
+
+_near_index = None
+
+def near_index() -> NearDuplicateIndex:
+    """Returns the near duplicate index, loading the newest entries of the duplicate log on first use"""
+    global _near_index
+    if _near_index is None:
+        index = NearDuplicateIndex(config.NEAR_DUPLICATE_SIMILARITY, config.NEAR_DUPLICATE_SIZE_TOLERANCE,
+                                   config.NEAR_DUPLICATE_HISTORY)
+        if unified_duplicate_log.exists():
+            with unified_duplicate_log.open("r", newline='') as f:
+                rows = deque((row for row in csv.reader(f) if len(row) > 1 and row[1].isdigit()),
+                             maxlen=config.NEAR_DUPLICATE_HISTORY)
+            for row in rows:
+                index.add(row[0], row[1])
+        _near_index = index
+    return _near_index
+
+def is_near_duplicate_file(f) -> bool:
+    return near_index().probably_seen(f.name, f.size)
+
+def near_duplicate_policy(room: str) -> str:
+    """Returns the configured near duplicate policy for a room, room specific entries win"""
+    default = room_policy = None
+    for item in config.NEAR_DUPLICATE_POLICY:
+        name, _, item_room = item.partition("#")
+        if item_room == room:
+            room_policy = name
+        elif not item_room and default is None:
+            default = name
+    policy = (room_policy or default or "download").lower()
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown near duplicate policy: {policy}")
+    return policy